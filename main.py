@@ -1,13 +1,13 @@
+import json
 import os
-import re
-from datetime import datetime
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
+import uvicorn
 
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse
+from fastapi import FastAPI, Request, Form, HTTPException, Depends, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
 
@@ -15,122 +15,230 @@ from fastapi.staticfiles import StaticFiles
 APP_NAME = "Digital Circular Passport"
 TOTAL_ACTIVITIES = 6
 QR_PREFIX = "CF26-"
+ADMIN_PAGE_SIZE = 100
+# Advisory lock key that serializes init_db across workers.
+SCHEMA_LOCK_ID = 7243160026
 
-SECRET_KEY = os.getenv("SECRET_KEY", "super-secret-key")
+IS_PROD = os.getenv("ENV") == "prod"
 
-app = FastAPI()
+SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY:
+    if IS_PROD:
+        raise RuntimeError("SECRET_KEY is not set")
+    SECRET_KEY = "super-secret-key"
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 templates = Jinja2Templates(directory="templates")
+if IS_PROD:
+    os.makedirs(".jinja_cache", exist_ok=True)
+    templates.env.auto_reload = False
+    templates.env.bytecode_cache = FileSystemBytecodeCache(".jinja_cache")
+
+
+def get_db(request: Request):
+    return request.app.state.pool.acquire()
+
 
+async def init_connection(conn):
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
 
-def get_db():
+
+async def create_pool():
     database_url = os.getenv("DATABASE_URL")
     if not database_url:
         raise RuntimeError("DATABASE_URL is not set")
-    return psycopg2.connect(database_url)
-
+    return await asyncpg.create_pool(
+        database_url,
+        min_size=int(os.getenv("DB_POOL_MIN", "2")),
+        max_size=int(os.getenv("DB_POOL_MAX", "10")),
+        command_timeout=10,
+        # asyncpg prepares every query and caches it per connection; keep
+        # those statements for the connection's lifetime instead of
+        # re-preparing them every five minutes. Set DB_STATEMENT_CACHE_SIZE=0
+        # behind PgBouncer in transaction mode, where named prepared
+        # statements don't survive between transactions.
+        statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+        max_cached_statement_lifetime=0,
+        # create_pool() already opens min_size connections up front; don't
+        # let idle ones be closed between bursts of scans either.
+        max_inactive_connection_lifetime=0,
+        init=init_connection,
+    )
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
 
-    cur.execute("""
+async def init_db(conn):
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS users (
         id SERIAL PRIMARY KEY,
         name TEXT NOT NULL,
         email TEXT UNIQUE NOT NULL,
-        created_at TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
         group_name TEXT
     )
     """)
 
-    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS group_name TEXT")
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS group_name TEXT")
 
-    cur.execute("""
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS activities (
         code TEXT PRIMARY KEY,
         title TEXT NOT NULL
     )
     """)
 
-    cur.execute("""
+    await conn.execute("""
     CREATE TABLE IF NOT EXISTS completions (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
         activity_code TEXT NOT NULL,
-        created_at TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
         UNIQUE(user_id, activity_code)
     )
     """)
 
-    for i in range(1, TOTAL_ACTIVITIES + 1):
-        code = f"CF26-A{str(i).zfill(2)}"
-        title = f"Activity {i}"
-        cur.execute(
-            "INSERT INTO activities (code, title) VALUES (%s, %s) ON CONFLICT (code) DO NOTHING",
-            (code, title),
+    # Older databases stored created_at as naive UTC ISO strings.
+    for table in ("users", "completions"):
+        created_at_type = await conn.fetchval("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema()
+                AND table_name = $1
+                AND column_name = 'created_at'
+        """, table)
+        if created_at_type == "text":
+            await conn.execute(f"""
+                ALTER TABLE {table}
+                    ALTER COLUMN created_at TYPE TIMESTAMPTZ
+                        USING created_at::timestamp AT TIME ZONE 'UTC',
+                    ALTER COLUMN created_at SET DEFAULT now()
+            """)
+
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS completions_user_created_idx "
+        "ON completions (user_id, created_at DESC)"
+    )
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS users_group_name_idx ON users (group_name, name)"
+    )
+
+    # users.completion_count is maintained by a trigger on completions, so it
+    # stays correct whatever code path inserts or deletes a completion.
+    await conn.execute(
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS completion_count INTEGER NOT NULL DEFAULT 0"
+    )
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION completions_count_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE users SET completion_count = completion_count + 1 WHERE id = NEW.user_id;
+            ELSE
+                UPDATE users SET completion_count = completion_count - 1 WHERE id = OLD.user_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+    has_count_trigger = await conn.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_trigger
+            WHERE tgrelid = 'completions'::regclass AND tgname = 'completions_count'
         )
+    """)
+
+    # Creating the trigger blocks inserts into completions until this
+    # transaction commits, so the backfill below can't miss a row.
+    if not has_count_trigger:
+        await conn.execute("""
+            CREATE TRIGGER completions_count
+            AFTER INSERT OR DELETE ON completions
+            FOR EACH ROW EXECUTE FUNCTION completions_count_trigger()
+        """)
+        await conn.execute("""
+            UPDATE users u SET completion_count = (
+                SELECT COUNT(*) FROM completions c WHERE c.user_id = u.id
+            )
+        """)
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    codes = [f"CF26-A{str(i).zfill(2)}" for i in range(1, TOTAL_ACTIVITIES + 1)]
+    titles = [f"Activity {i}" for i in range(1, TOTAL_ACTIVITIES + 1)]
+    await conn.execute("""
+        INSERT INTO activities (code, title)
+        SELECT * FROM unnest($1::text[], $2::text[])
+        ON CONFLICT (code) DO NOTHING
+    """, codes, titles)
 
 
 @app.on_event("startup")
-def on_startup():
-    init_db()
+async def on_startup():
+    app.state.pool = await create_pool()
+    async with app.state.pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+            await init_db(conn)
+        app.state.activity_codes = frozenset(
+            r[0] for r in await conn.fetch("SELECT code FROM activities")
+        )
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await app.state.pool.close()
 
 
 def current_user(request: Request):
     return request.session.get("user_id")
 
 
-def require_login(request: Request):
+async def require_login(request: Request):
     user_id = current_user(request)
     if not user_id:
         raise HTTPException(status_code=401)
     return user_id
 
 
-def get_progress(user_id: int):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    cur.execute("SELECT COUNT(*) AS count FROM completions WHERE user_id=%s", (user_id,))
-    count = cur.fetchone()["count"]
-
-    cur.execute("""
-        SELECT a.code, a.title, c.created_at
-        FROM completions c
-        JOIN activities a ON a.code = c.activity_code
-        WHERE c.user_id=%s
-        ORDER BY c.created_at DESC
-        LIMIT 10
-    """, (user_id,))
-    items = cur.fetchall()
-
-    cur.close()
-    conn.close()
+# A user's completions, newest first. {user_id} is filled in with a bind
+# parameter or an outer column reference.
+HISTORY_SQL = """
+    SELECT
+        a.code,
+        a.title,
+        to_char(c.created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI') AS created_at,
+        c.created_at AS completed_at
+    FROM completions c
+    JOIN activities a ON a.code = c.activity_code
+    WHERE c.user_id = {user_id}
+    ORDER BY c.created_at DESC
+"""
+
+
+async def get_progress(conn, user_id: int):
+    count = await conn.fetchval("SELECT completion_count FROM users WHERE id=$1", user_id)
+    items = await conn.fetch(HISTORY_SQL.format(user_id="$1"), user_id)
     return count, items
 
 
 def valid_qr(code: str):
-    if not code.startswith(QR_PREFIX):
-        return False
-    suffix = code[len(QR_PREFIX):]
-    return bool(re.match(r"A\d{2}$", suffix))
+    # Codes are always QR_PREFIX + "A" + two ASCII digits, e.g. CF26-A01.
+    return (
+        len(code) == len(QR_PREFIX) + 3
+        and code.startswith(QR_PREFIX)
+        and code[-3] == "A"
+        and code[-2] in "0123456789"
+        and code[-1] in "0123456789"
+    )
 
 
 @app.get("/", response_class=HTMLResponse)
-def home(request: Request):
+async def home(request: Request):
     if current_user(request):
         return RedirectResponse("/app", status_code=303)
     return RedirectResponse("/register", status_code=303)
 
 
 @app.get("/register", response_class=HTMLResponse)
-def register_page(request: Request):
+async def register_page(request: Request):
     return templates.TemplateResponse("register.html", {
         "request": request,
         "app_name": APP_NAME
@@ -138,81 +246,78 @@ def register_page(request: Request):
 
 
 @app.post("/register")
-def register(request: Request, name: str = Form(...), email: str = Form(...)):
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
+async def register(request: Request, name: str = Form(...), email: str = Form(...)):
     email = email.strip().lower()
     name = name.strip()
 
-    cur.execute("SELECT id FROM users WHERE email=%s", (email,))
-    row = cur.fetchone()
+    async with get_db(request) as conn:
+        user_id = await conn.fetchval("SELECT id FROM users WHERE email=$1", email)
 
-    if row:
-        user_id = row["id"]
-    else:
-        cur.execute(
-            "INSERT INTO users (name, email, created_at) VALUES (%s, %s, %s) RETURNING id",
-            (name, email, datetime.utcnow().isoformat())
-        )
-        user_id = cur.fetchone()["id"]
-        conn.commit()
-
-    cur.close()
-    conn.close()
+        if user_id is None:
+            user_id = await conn.fetchval(
+                "INSERT INTO users (name, email) VALUES ($1, $2) RETURNING id",
+                name, email
+            )
 
     request.session["user_id"] = user_id
     return RedirectResponse("/app", status_code=303)
 
 
-@app.get("/app", response_class=HTMLResponse)
-def app_page(request: Request):
-    user_id = require_login(request)
+APP_PAGE_SQL = f"""
+    SELECT
+        u.name,
+        u.email,
+        u.group_name,
+        u.completion_count,
+        COALESCE((
+            SELECT json_agg(
+                json_build_object('code', r.code, 'title', r.title, 'created_at', r.created_at)
+                ORDER BY r.completed_at DESC
+            )
+            FROM ({HISTORY_SQL.format(user_id="u.id")} LIMIT 10) r
+        ), '[]') AS items
+    FROM users u
+    WHERE u.id=$1
+"""
 
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT name, email, group_name FROM users WHERE id=%s", (user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
 
-    count, items = get_progress(user_id)
+@app.get("/app", response_class=HTMLResponse)
+async def app_page(request: Request, user_id: int = Depends(require_login)):
+    async with get_db(request) as conn:
+        user = await conn.fetchrow(APP_PAGE_SQL, user_id)
 
     return templates.TemplateResponse("app.html", {
         "request": request,
         "app_name": APP_NAME,
         "user": user,
-        "count": count,
+        "count": user["completion_count"],
         "total": TOTAL_ACTIVITIES,
-        "items": items,
+        "items": user["items"],
         "needs_group": not bool(user["group_name"])
     })
 
 
 @app.post("/save-group")
-def save_group(request: Request, group_name: str = Form(...)):
-    user_id = require_login(request)
-
+async def save_group(
+    request: Request,
+    group_name: str = Form(...),
+    user_id: int = Depends(require_login),
+):
     allowed_groups = [f"Group {i}" for i in range(1, 56)]
     if group_name not in allowed_groups:
         raise HTTPException(status_code=400, detail="Invalid group")
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET group_name=%s WHERE id=%s",
-        (group_name, user_id)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    async with get_db(request) as conn:
+        await conn.execute(
+            "UPDATE users SET group_name=$1 WHERE id=$2",
+            group_name, user_id
+        )
 
     return RedirectResponse("/app", status_code=303)
 
 
-@app.get("/scan", response_class=HTMLResponse)
-def scan_page(request: Request):
-    require_login(request)
+@app.get("/scan", response_class=HTMLResponse, dependencies=[Depends(require_login)])
+async def scan_page(request: Request):
     return templates.TemplateResponse("scan.html", {
         "request": request,
         "prefix": QR_PREFIX
@@ -220,59 +325,42 @@ def scan_page(request: Request):
 
 
 @app.post("/api/scan")
-def scan_api(request: Request, code: str = Form(...)):
-    user_id = require_login(request)
+async def scan_api(
+    request: Request,
+    code: str = Form(...),
+    user_id: int = Depends(require_login),
+):
     code = code.strip()
 
     if not valid_qr(code):
-        return JSONResponse({"ok": False, "error": "Invalid QR"}, status_code=400)
-
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    cur.execute("SELECT code FROM activities WHERE code=%s", (code,))
-    if not cur.fetchone():
-        cur.close()
-        conn.close()
-        return JSONResponse({"ok": False, "error": "Unknown activity"}, status_code=404)
-
-    cur.execute(
-        "INSERT INTO completions (user_id, activity_code, created_at) VALUES (%s, %s, %s) "
-        "ON CONFLICT (user_id, activity_code) DO NOTHING RETURNING id",
-        (user_id, code, datetime.utcnow().isoformat())
-    )
-    added = cur.fetchone() is not None
-    conn.commit()
-
-    cur.execute("SELECT COUNT(*) AS count FROM completions WHERE user_id=%s", (user_id,))
-    count = cur.fetchone()["count"]
-
-    cur.close()
-    conn.close()
+        return ORJSONResponse({"ok": False, "error": "Invalid QR"}, status_code=400)
+
+    if code not in request.app.state.activity_codes:
+        return ORJSONResponse({"ok": False, "error": "Unknown activity"}, status_code=404)
+
+    # The trigger's counter update is not visible to this statement's
+    # snapshot, so the new row (if any) is added on top.
+    async with get_db(request) as conn:
+        row = await conn.fetchrow("""
+            WITH ins AS (
+                INSERT INTO completions (user_id, activity_code)
+                VALUES ($1, $2)
+                ON CONFLICT (user_id, activity_code) DO NOTHING
+                RETURNING id
+            )
+            SELECT
+                (SELECT completion_count FROM users WHERE id=$1)
+                    + (SELECT COUNT(*) FROM ins) AS count,
+                EXISTS (SELECT 1 FROM ins) AS added
+        """, user_id, code)
 
-    return {"ok": True, "added": added, "count": count, "total": TOTAL_ACTIVITIES}
+    return {"ok": True, "added": row["added"], "count": row["count"], "total": TOTAL_ACTIVITIES}
 
 
 @app.get("/progress", response_class=HTMLResponse)
-def progress_page(request: Request):
-    user_id = require_login(request)
-
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("""
-        SELECT a.code, a.title, c.created_at
-        FROM completions c
-        JOIN activities a ON a.code = c.activity_code
-        WHERE c.user_id=%s
-        ORDER BY c.created_at DESC
-    """, (user_id,))
-    items = cur.fetchall()
-
-    cur.execute("SELECT COUNT(*) AS count FROM completions WHERE user_id=%s", (user_id,))
-    count = cur.fetchone()["count"]
-
-    cur.close()
-    conn.close()
+async def progress_page(request: Request, user_id: int = Depends(require_login)):
+    async with get_db(request) as conn:
+        count, items = await get_progress(conn, user_id)
 
     return templates.TemplateResponse("progress.html", {
         "request": request,
@@ -283,76 +371,97 @@ def progress_page(request: Request):
 
 
 @app.get("/admin/students", response_class=HTMLResponse)
-def admin_students(request: Request, key: str = "", group_name: str = ""):
+async def admin_students(
+    request: Request,
+    key: str = "",
+    group_name: str = "",
+    q: str = "",
+    page: int = Query(1, ge=1, le=10000),
+):
     if key != os.getenv("ADMIN_KEY", ""):
         return PlainTextResponse("Forbidden", status_code=403)
 
-    conn = get_db()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    cur.execute("SELECT COUNT(*) AS n FROM users")
-    total_users = cur.fetchone()["n"]
-
-    if group_name:
-        cur.execute("""
-            SELECT
-                u.id,
-                u.name,
-                u.email,
-                u.group_name,
-                COUNT(c.id) AS cnt,
-                COALESCE(
-                    ARRAY_AGG(
-                        a.title || ' [' || a.code || ']'
+    q = q.strip()
+    # NULL disables the search; otherwise match q literally anywhere in
+    # the name or email.
+    pattern = None
+    if q:
+        escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+    # One extra row tells us whether there is a next page.
+    limit = ADMIN_PAGE_SIZE + 1
+    offset = (page - 1) * ADMIN_PAGE_SIZE
+
+    async with get_db(request) as conn:
+        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
+
+        if group_name:
+            rows = await conn.fetch("""
+                SELECT
+                    u.id,
+                    u.name,
+                    u.email,
+                    u.group_name,
+                    u.completion_count AS cnt,
+                    ARRAY(
+                        SELECT a.title || ' [' || a.code || ']'
+                        FROM completions c
+                        JOIN activities a ON a.code = c.activity_code
+                        WHERE c.user_id = u.id
                         ORDER BY c.created_at DESC
-                    ) FILTER (WHERE c.id IS NOT NULL),
-                    ARRAY[]::TEXT[]
-                ) AS activities
-            FROM users u
-            LEFT JOIN completions c ON c.user_id = u.id
-            LEFT JOIN activities a ON a.code = c.activity_code
-            WHERE u.group_name = %s
-            GROUP BY u.id, u.name, u.email, u.group_name
-            ORDER BY u.name ASC
-        """, (group_name,))
-    else:
-        cur.execute("""
-            SELECT
-                u.id,
-                u.name,
-                u.email,
-                u.group_name,
-                COUNT(c.id) AS cnt,
-                COALESCE(
-                    ARRAY_AGG(
-                        a.title || ' [' || a.code || ']'
+                    ) AS activities
+                FROM users u
+                WHERE u.group_name = $1
+                    AND ($2::text IS NULL OR u.name ILIKE $2 OR u.email ILIKE $2)
+                ORDER BY u.name ASC
+                LIMIT $3 OFFSET $4
+            """, group_name, pattern, limit, offset)
+        else:
+            rows = await conn.fetch("""
+                SELECT
+                    u.id,
+                    u.name,
+                    u.email,
+                    u.group_name,
+                    u.completion_count AS cnt,
+                    ARRAY(
+                        SELECT a.title || ' [' || a.code || ']'
+                        FROM completions c
+                        JOIN activities a ON a.code = c.activity_code
+                        WHERE c.user_id = u.id
                         ORDER BY c.created_at DESC
-                    ) FILTER (WHERE c.id IS NOT NULL),
-                    ARRAY[]::TEXT[]
-                ) AS activities
-            FROM users u
-            LEFT JOIN completions c ON c.user_id = u.id
-            LEFT JOIN activities a ON a.code = c.activity_code
-            GROUP BY u.id, u.name, u.email, u.group_name
-            ORDER BY u.group_name NULLS LAST, u.name ASC
-        """)
-
-    rows = cur.fetchall()
-
-    cur.close()
-    conn.close()
+                    ) AS activities
+                FROM users u
+                WHERE $1::text IS NULL OR u.name ILIKE $1 OR u.email ILIKE $1
+                ORDER BY u.group_name NULLS LAST, u.name ASC
+                LIMIT $2 OFFSET $3
+            """, pattern, limit, offset)
 
     return templates.TemplateResponse("admin_students.html", {
         "request": request,
-        "rows": rows,
+        "rows": rows[:ADMIN_PAGE_SIZE],
         "total": TOTAL_ACTIVITIES,
         "total_users": total_users,
         "selected_group": group_name,
-        "admin_key": key
+        "query": q,
+        "admin_key": key,
+        "page": page,
+        "has_next": len(rows) > ADMIN_PAGE_SIZE
     })
 
 
 @app.get("/logout")
-def logout(request: Request):
+async def logout(request: Request):
     request.session.clear()
     return RedirectResponse("/register", status_code=303)
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )